@@ -149,16 +149,15 @@ def graph_info(sizes, G_subgraph, mappings):
 
     for m in mappings:
 
-        ug = networkx.relabel_nodes(G_subgraph, m, copy=True)
+        ug = nx.relabel_nodes(G_subgraph, m, copy=True)
         vn = valences(sizes, ug)
 
-        e = list(ug.edges())
-        e.sort()
+        e = tuple(sorted(ug.edges()))
 
+        # edge sets are deduplicated in the order they are first seen (dict keys)
         if str(vn) not in frags:
-            frags[str(vn)] = [e]
+            frags[str(vn)] = {e: None}
         else:
-            if e not in frags[str(vn)]:
-                frags[str(vn)].append(e)
+            frags[str(vn)][e] = None
 
     return frags, (sizes, G_subgraph, mappings)
@@ -46,11 +46,17 @@ def subset_sum(l, mass, toll=0.001):
         yield [l[0]] + subset
 
 
-def combine_ecs(ss2_grp, heavy_atoms, db, accuracy=None, ppm=None):
+def combine_ecs(ss2_grp, heavy_atoms, db, accuracy=None, ppm=None, ecs_cache=None):
     ecs = []
 
     for i in range(len(ss2_grp)):
-        atoms = db.select_ecs(ss2_grp[i], heavy_atoms, accuracy, ppm=ppm)
+        # the same mass values recur across subsets; query each of them only once per build
+        if ecs_cache is not None and ss2_grp[i] in ecs_cache:
+            atoms = ecs_cache[ss2_grp[i]]
+        else:
+            atoms = db.select_ecs(ss2_grp[i], heavy_atoms, accuracy, ppm=ppm)
+            if ecs_cache is not None:
+                ecs_cache[ss2_grp[i]] = atoms
 
         if len(atoms) == 0:
             return []
@@ -68,6 +74,7 @@ def reindex_atoms(records):
     c = 0
     for record in records:
         idxs = []
+        dummies = set(record["dummies"])
         for atom in record["mol"].GetAtoms():
 
             newIdx = atom.GetIdx() + c
@@ -75,7 +82,7 @@ def reindex_atoms(records):
 
             if atom.GetIdx() in record["degree_atoms"]:
                 atoms_available.append(newIdx)
-            if atom.GetIdx() in record["dummies"]:
+            if atom.GetIdx() in dummies:
                 atoms_to_remove.append(newIdx)
             if atom.GetIdx() in record["bond_types"]:
                 bond_types[newIdx] = record["bond_types"][atom.GetIdx()]
@@ -87,11 +94,12 @@ def reindex_atoms(records):
     return mol_comb, atoms_available, atoms_to_remove, bond_types
 
 
-def add_bonds(mols, edges, atoms_available, bond_types, debug=False):
-    rdkit_bond_types = {1: Chem.rdchem.BondType.SINGLE,
-                        1.5: Chem.rdchem.BondType.AROMATIC,
-                        2: Chem.rdchem.BondType.DOUBLE}
+_RDKIT_BOND_TYPES = {1: Chem.rdchem.BondType.SINGLE,
+                     1.5: Chem.rdchem.BondType.AROMATIC,
+                     2: Chem.rdchem.BondType.DOUBLE}
 
+
+def add_bonds(mols, edges, atoms_available, bond_types, debug=False):
     G = nx.Graph()
     G.add_edges_from(edges)
 
@@ -135,9 +143,9 @@ def add_bonds(mols, edges, atoms_available, bond_types, debug=False):
             bt_start.remove(bondMatches[0])
             bt_end.remove(bondMatches[0])
 
-        # print(edge[0], edge[1], rdkit_bond_types[bondMatches[0]])
+        # print(edge[0], edge[1], _RDKIT_BOND_TYPES[bondMatches[0]])
         try:
-            mol_edit.AddBond(edge[0], edge[1], rdkit_bond_types[bondMatches[0]])
+            mol_edit.AddBond(edge[0], edge[1], _RDKIT_BOND_TYPES[bondMatches[0]])
         except KeyError:
             if debug:
                 print("Unknown bond type")
@@ -168,7 +176,15 @@ def build(mc, exact_mass, db, fn_out, heavy_atoms, max_valence, accuracy, fragme
     subsets = list(subset_sum(mass_values, exact_mass__1))
 
     configs_iso = db.k_configs()
-    out = open(fn_out, "w")
+    # both caches only live for this build, so they never outlive a change to the database
+    ecs_cache = {}
+    sub_structures_cache = {}
+
+    # fn_out is either a path or an already open (text) file, e.g. one shared by several builds
+    if hasattr(fn_out, "write"):
+        out = fn_out
+    else:
+        out = open(fn_out, "w", buffering=1 << 20)
 
     if debug:
         print("First round (mass: {}) - Values: {} - Correct Sums: {}".format(exact_mass__1, len(mass_values),
@@ -190,14 +206,17 @@ def build(mc, exact_mass, db, fn_out, heavy_atoms, max_valence, accuracy, fragme
                                                                                    len(subsets_r2)))
             print("------------------------------------------------------")
 
-        build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm, debug)
+        build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm, debug, ecs_cache,
+                           sub_structures_cache)
 
-    out.close()
+    if out is not fn_out:
+        out.close()
 
 
-def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=None, debug=False):
+def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=None, debug=False, ecs_cache=None,
+                       sub_structures_cache=None):
     for ss2_grp in subsets_r2:
-        list_ecs = combine_ecs(ss2_grp, heavy_atoms, db, "0_0001", ppm)
+        list_ecs = combine_ecs(ss2_grp, heavy_atoms, db, "0_0001", ppm, ecs_cache)
 
         if len(list_ecs) == 0:
             continue
@@ -216,7 +235,7 @@ def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=No
                 if debug:
                     print("Match elemental composition: {}".format(str(sum_ec)))
 
-                ll = db.select_sub_structures(l)
+                ll = db.select_sub_structures(l, sub_structures_cache)
 
                 if len(ll) == 0:
                     if debug:
@@ -248,19 +267,21 @@ def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=No
                         v = v + (d["valence"],)
                         vA = vA + (tuple(d["degree_atoms"].values()),)
 
+                    str_vA = str(vA)  # key into configs_iso, built once per combination
                     if debug:
-                        print(str(vA))
+                        print(str_vA)
                         print("============")
                     # print(configs_iso)
                     # print("============")
 
-                    if str(vA) not in configs_iso:
+                    id_pkl = configs_iso.get(str_vA)
+                    if id_pkl is None:
                         if debug:
-                            print("NO:", (str(nA), str(v), str(vA)))
+                            print("NO:", (str(nA), str(v), str_vA))
                         continue
                     else:
                         if debug:
-                            print("YES:", (str(nA), str(v), str(vA)))
+                            print("YES:", (str(nA), str(v), str_vA))
 
                     # print("## ConnectivityGraphs found (%s)" % (len(list(db.isomorphismGraphs(str(tuple(nA)), str(tuple(v)))))))
                     # print("## Atoms available (n) %s / Valence %s" % (str(tuple(nA)), str(tuple(v))))
@@ -271,8 +292,12 @@ def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=No
                         print("## Atoms Available (indexes):", atoms_available)
                         print("## Atoms to remove (dummies):", atoms_to_remove)
                         print("## Type of bonds to form:", bond_types)
+
+                    # dummies are removed from the highest index down; sort once for all isomorphisms
+                    atoms_to_remove.sort(reverse=True)
+                    smiles_subs = str([item["smiles"] for item in lll])
                     iso_n = 0
-                    for edges in db.isomorphism_graphs(configs_iso[str(vA)]):  # EDGES
+                    for edges in db.isomorphism_graphs(id_pkl):  # EDGES
 
                         iso_n += 1
                         if debug:
@@ -287,7 +312,6 @@ def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=No
                         if debug:
                             print("2: Add bonds")
 
-                        atoms_to_remove.sort(reverse=True)
                         [mol_e.RemoveAtom(a) for a in atoms_to_remove]
 
                         molOut = mol_e.GetMol()
@@ -301,11 +325,11 @@ def build_from_subsets(configs_iso, subsets_r2, mc, db, out, heavy_atoms, ppm=No
 
                         # Draw.MolToFile(molOut, "main_after_" + "-".join(map(str, atoms_available)) + '.png')
                         try:
-                            out.write("{}\t{}\n".format(Chem.MolToSmiles(molOut, kekuleSmiles=True),
-                                                        str([item["smiles"] for item in lll])))
+                            smi = Chem.MolToSmiles(molOut, kekuleSmiles=True)
+                            out.write("{}\t{}\n".format(smi, smiles_subs))
                         except RuntimeError:
                             if debug:
                                 print("Bad bond type violation")
+                            continue
                         if debug:
-                            print("## smi (result): {}".format(
-                                Chem.MolToSmiles(molOut, kekuleSmiles=True)))  # , bond_types
+                            print("## smi (result): {}".format(smi))  # , bond_types
@@ -19,15 +19,20 @@
 # along with MetaboVerse.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import ast
+import functools
 import io
+import itertools
+import multiprocessing
 import os
 from io import BytesIO
 import subprocess
 import pickle
+import re
 import sqlite3
-import sys
 import tempfile
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from operator import itemgetter
 import xml.etree.ElementTree as etree
 import networkx as nx
 from rdkit import Chem
@@ -35,67 +40,126 @@ from rdkit.Chem import Recap
 from rdkit.Chem import BRICS
 from .auxiliary import calculate_complete_multipartite_graphs, graph_to_ri, graph_info
 
-sqlite3.register_converter("PICKLE", pickle.loads)
 
+def _dumps_lib(lib):
+    # store the RDKit mol as its compact binary representation instead of pickling the Mol object
+    lib = dict(lib, mol=lib["mol"].ToBinary())
+    return pickle.dumps(lib, protocol=pickle.HIGHEST_PROTOCOL)
 
-def reformat_xml(source, encoding="utf8"):
-    with io.open(source, "r", encoding=encoding) as xml:
-        xml_contents = xml.readlines()
-        if "hmdb" in xml_contents[1]:
-            return source
 
-        xml_contents.insert(1, "<hmdb xmlns=\"http://www.hmdb.ca\"> \n")
+def _loads_lib(pkl_lib):
+    lib = pickle.loads(pkl_lib)
+    lib["mol"] = Chem.Mol(lib["mol"])
+    return lib
 
-    with io.open(source, "w", encoding=encoding) as xml:
-        xml_contents = "".join(xml_contents)
-        xml.write(xml_contents)
-        xml.write("</hmdb>")
 
-    return source
+sqlite3.register_converter("PICKLE", _loads_lib)
 
 
-def parse_xml(source, encoding="utf8", reformat=True):
-    if reformat:
-        reformat_xml(source, encoding)
+class _XmlStream:
+    # minimal file-like object to feed a sequence of text chunks to etree.iterparse
 
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, "")
+
+
+_XML_PROLOG = re.compile(r"\s*(?:<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>)", re.DOTALL)
+_XML_ELEMENT = re.compile(r"\s*<([^\s/>!?]+)")
+
+
+def _read_prolog(inp):
+    # read up to the first element, skipping the XML declaration, comments and a doctype;
+    # returns the text read, the offset of the first element and its tag (without namespace prefix)
+    head = ""
+    pos = 0
+    while True:
+        line = inp.readline()
+        head += line
+        m = _XML_PROLOG.match(head, pos)
+        while m is not None:
+            pos = m.end()
+            m = _XML_PROLOG.match(head, pos)
+
+        # whole lines are read, so a matched tag name is always complete
+        m = _XML_ELEMENT.match(head, pos)
+        if m is not None:
+            return head, m.start(1) - 1, m.group(1).rpartition(":")[2]
+        # anything but an unfinished comment or declaration is not XML the parser would accept either
+        rest = head[pos:].lstrip()
+        if not line or (rest and not rest.startswith("<")):
+            return head, len(head), None
+
+
+def parse_xml(source, encoding="utf8"):
     with io.open(source, "r", encoding=encoding) as inp:
         record_out = OrderedDict()
 
-        xmldec = inp.readline()
-        xmldec2 = inp.readline()
+        head, start, tag = _read_prolog(inp)
+        if tag == "metabolite" or tag == "drug":
+            # records without a root element (e.g. a single HMDB metabolite); wrap them on the fly
+            xml_start = head[:start] + "<hmdb xmlns=\"http://www.hmdb.ca\">\n" + head[start:]
+            xml_end = ["</hmdb>"]
+        else:
+            xml_start = head
+            xml_end = []
+        xml = _XmlStream(itertools.chain([xml_start], iter(lambda: inp.read(16 * 1024), ""), xml_end))
 
-        xml_record = ""
+        root = None
         path = []
 
-        for line in inp:
-            xml_record += line
-            if line == "</metabolite>\n" or line == "</drug>\n":
+        # stream the whole document; text is only complete at the 'end' event of an element
+        for event, elem in etree.iterparse(xml, events=("start", "end")):
+            tag = elem.tag.rpartition("}")[2]  # strip namespace (e.g. {http://www.hmdb.ca})
 
-                if sys.version_info[0] == 3:
-                    inp = io.StringIO(xml_record)
-                else:
-                    inp = io.BytesIO(xml_record.encode('utf-8').strip())
-
-                for event, elem in etree.iterparse(inp, events=("start", "end")):
-                    if event == 'end':
-                        path.pop()
-
-                    if event == 'start':
-                        path.append(elem.tag)
-                        if elem.text != None:
-                            if elem.text.replace(" ", "") != "\n":
-
-                                path_elem = ".".join(map(str, path[1:]))
-                                if path_elem in record_out:
-                                    if type(record_out[path_elem]) != list:
-                                        record_out[path_elem] = [record_out[path_elem]]
-                                    record_out[path_elem].append(elem.text)
-                                else:
-                                    record_out[path_elem] = elem.text
-
-                xml_record = ""
+            if event == 'start':
+                if root is None:
+                    root = elem
+                path.append(tag)
+                continue
+
+            if len(path) == 2 and (tag == "metabolite" or tag == "drug"):
                 yield record_out
                 record_out = OrderedDict()
+                root.clear()  # free the parsed record
+
+            elif elem.text != None and len(path) > 2:
+                if elem.text.replace(" ", "") != "\n":
+
+                    path_elem = ".".join(path[2:])
+                    if path_elem in record_out:
+                        if type(record_out[path_elem]) != list:
+                            record_out[path_elem] = [record_out[path_elem]]
+                        record_out[path_elem].append(elem.text)
+                    else:
+                        record_out[path_elem] = elem.text
+
+            path.pop()
+
+
+def _paths(tree, cur=()):
+    # iterative depth-first walk; children are pushed in reverse to keep the original order
+    stack = [(tree, cur)]
+    while stack:
+        tree, cur = stack.pop()
+        if tree == {}:
+            yield cur
+        else:
+            for n, s in reversed(list(tree.items())):
+                stack.append((s, cur + (n,)))
+
+
+@functools.lru_cache(maxsize=128)
+def _load_isomorphism_graphs(fn_pkl, mtime_ns=None, size=None):
+    # the same pickle is requested for every matching substructure combination; load and flatten it once.
+    # mtime_ns and size are only part of the cache key, so a rewritten pickle is loaded again
+    with open(fn_pkl, 'rb') as pickle_file:
+        nGcomplete = pickle.load(pickle_file)
+    if isinstance(nGcomplete, dict):  # trie written by older versions
+        return tuple(_paths(nGcomplete))
+    return tuple(nGcomplete)
 
 
 class ConnectivityDb:
@@ -114,17 +178,22 @@ class SubstructureDb:
         self.conn = sqlite3.connect(self.db)
         self.cursor = self.conn.cursor()
 
+        # read settings; mmap_size is capped by the compile-time maximum of SQLite
+        self.cursor.execute("PRAGMA mmap_size=1099511627776")
+        self.cursor.execute("PRAGMA cache_size=-262144")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+
         if self.db2 is not None:
-            self.cursor.execute("""ATTACH DATABASE '%s' as 'graphs';""" % self.db2)
+            self.cursor.execute("ATTACH DATABASE ? AS graphs", (self.db2,))
 
     def select_compounds(self, cpds=[]):
         if len(cpds) > 0:
-            sql = " WHERE HMDBID in ('%s')" % (", ".join(map(str, cpds)))
+            sql = " WHERE HMDBID in ({})".format(",".join("?" * len(cpds)))
         else:
             sql = ""
 
         self.cursor.execute("""select distinct HMDBID, exact_mass, formula, C, H, N, O, P, S, SMILES,
-                            SMILES_RDKIT, SMILES_RDKIT_KEK from compounds%s""" % sql)
+                            SMILES_RDKIT, SMILES_RDKIT_KEK from compounds%s""" % sql, tuple(map(str, cpds)))
         return self.cursor.fetchall()
 
     def filter_hmdbid_substructures(self, min_node_weight):
@@ -135,7 +204,8 @@ class SubstructureDb:
 
         self.cursor.execute("""create table filtered_hmdbid_substructures as
                             select smiles_rdkit_kek, COUNT(*) from hmdbid_substructures
-                            group by smiles_rdkit_kek having COUNT(*) >=%s""" % min_node_weight)
+                            group by smiles_rdkit_kek having COUNT(*) >= ?""", (min_node_weight,))
+        self.cursor.execute("""create index filtered__smiles__idx on filtered_hmdbid_substructures (smiles_rdkit_kek)""")
 
         return self.cursor.fetchall()
 
@@ -147,9 +217,9 @@ class SubstructureDb:
         unique_hmdb_ids = self.cursor.fetchall()
 
         self.cursor.execute("""select * from filtered_hmdbid_substructures""")
-        # add node for each unique substructure, weighted by count
-        for unique_substructure in self.cursor.fetchall():
-            substructure_graph.add_node(unique_substructure[0], weight=unique_substructure[1])
+        # add node for each unique substructure, weighted by count (rows are streamed from the cursor)
+        substructure_graph.add_nodes_from((unique_substructure[0], {"weight": unique_substructure[1]})
+                                          for unique_substructure in self.cursor)
 
         # generate different flavours of network
         if method == "default":
@@ -161,9 +231,9 @@ class SubstructureDb:
             substructure_graph = self.extended_substructure_network(substructure_graph, unique_hmdb_ids,
                                                                     include_parents=True)
 
-        # remove isolated nodes
+        # remove isolated nodes (empty adjacency dicts; avoids the degree view used by nx.isolates)
         if remove_isolated:
-            substructure_graph.remove_nodes_from(list(nx.isolates(substructure_graph)))
+            substructure_graph.remove_nodes_from([n for n, nbrs in substructure_graph.adj.items() if not nbrs])
 
         return substructure_graph
 
@@ -175,73 +245,66 @@ class SubstructureDb:
             substructure_graph.add_node(unique_hmdb_id[0])
 
         # add edge for each linked parent structure and substructure
-        self.cursor.execute("""select * from hmdbid_substructures where smiles_rdkit_kek in 
-                            (select smiles_rdkit_kek from filtered_hmdbid_substructures)""")
-        for hmdbid_substructures in self.cursor.fetchall():
-            substructure_graph.add_edge(hmdbid_substructures[0], hmdbid_substructures[1])
+        self.cursor.execute("""select hs.hmdbid, hs.smiles_rdkit_kek from hmdbid_substructures hs
+                            inner join filtered_hmdbid_substructures f using (smiles_rdkit_kek)""")
+        substructure_graph.add_edges_from(self.cursor)
 
         if not include_parents:
             # remove parent structures and replace with linked, weighted substructures
+            edges = Counter()
             for unique_hmdb_id in unique_hmdb_ids:
-                for adj1 in substructure_graph.adj[unique_hmdb_id[0]]:
-                    for adj2 in substructure_graph.adj[unique_hmdb_id[0]]:
-                        if substructure_graph.has_edge(adj1, adj2):
-                            substructure_graph[adj1][adj2]['weight'] += 1
-                        else:
-                            substructure_graph.add_edge(adj1, adj2, weight=1)
-                substructure_graph.remove_node(unique_hmdb_id[0])
+                edges.update(itertools.combinations(sorted(substructure_graph.adj[unique_hmdb_id[0]]), 2))
+            substructure_graph.remove_nodes_from(unique_hmdb_id[0] for unique_hmdb_id in unique_hmdb_ids)
 
-            # remove self-loops and edges below weight threshold
-            substructure_graph.remove_edges_from(nx.selfloop_edges(substructure_graph))
+            # each pair of substructures is counted in both directions (no self-loops are generated)
+            substructure_graph.add_weighted_edges_from((u, v, 2 * w) for (u, v), w in edges.items())
 
         return substructure_graph
 
     def default_substructure_network(self, substructure_graph, unique_hmdb_ids):
-        # add edges by walking through hmdbid_substructures
-        for unique_hmdb_id in unique_hmdb_ids:
-            self.cursor.execute("""select * from hmdbid_substructures where smiles_rdkit_kek in 
-                                (select smiles_rdkit_kek from filtered_hmdbid_substructures) and hmdbid = '%s'"""
-                                % unique_hmdb_id)
-            nodes = []
-            for substructure in self.cursor.fetchall():
-                for node in nodes:
-                    if substructure_graph.has_edge(substructure[1], node):
-                        substructure_graph[substructure[1]][node]['weight'] += 1
-                    else:
-                        substructure_graph.add_edge(substructure[1], node, weight=1)
+        # add edges by walking through hmdbid_substructures (single query, grouped by hmdbid)
+        self.cursor.execute("""select hs.hmdbid, hs.smiles_rdkit_kek from hmdbid_substructures hs
+                            inner join filtered_hmdbid_substructures f using (smiles_rdkit_kek)
+                            order by hs.hmdbid""")
+        hmdbids = set(unique_hmdb_id[0] for unique_hmdb_id in unique_hmdb_ids)
+        edges = Counter()
+        for hmdbid, substructures in itertools.groupby(self.cursor, key=itemgetter(0)):
+            if hmdbid not in hmdbids:
+                continue
+            nodes = sorted(substructure[1] for substructure in substructures)
+            edges.update(itertools.combinations(nodes, 2))
 
-                nodes.append(substructure[1])
+        substructure_graph.add_weighted_edges_from((u, v, w) for (u, v), w in edges.items())
 
         return substructure_graph
 
     def select_mass_values(self, accuracy, heavy_atoms, max_valence, masses):
-        mass_values = []
         filter_mass = ""
+        params = [max_valence] + list(heavy_atoms)
         if type(masses) == list:
             if len(masses) > 0:
-                filter_mass = " AND exact_mass__1 in ({})".format(",".join(map(str, masses)))
+                filter_mass = " AND exact_mass__1 in ({})".format(",".join("?" * len(masses)))
+                params.extend(masses)
 
         self.cursor.execute("""SELECT DISTINCT exact_mass__{}
                                    FROM substructures 
-                               WHERE valence <= {}
+                               WHERE valence <= ?
                                    AND heavy_atoms IN ({}){}
-                            """.format(accuracy, max_valence, ",".join(map(str, heavy_atoms)), filter_mass))
+                               ORDER BY exact_mass__{}
+                            """.format(accuracy, ",".join("?" * len(heavy_atoms)), filter_mass, accuracy), params)
 
-        records = self.cursor.fetchall()
-        for record in records:
-            mass_values.append(record[0])
-        mass_values.sort()
-        return mass_values
+        return [record[0] for record in self.cursor.fetchall()]
 
     def select_ecs(self, exact_mass, heavy_atoms, accuracy, ppm=None):
+        params = list(heavy_atoms)
         if ppm is None:
-            mass_statement = "= " + str(exact_mass)
+            mass_statement = "= ?"
+            params.append(exact_mass)
         else:
             tolerance = (exact_mass / 1000000) * ppm
-            mass_statement = "< {} AND exact_mass__{} > {}".format(exact_mass + tolerance,
-                                                                   accuracy,
-                                                                   exact_mass - tolerance)
-            
+            mass_statement = "< ? AND exact_mass__{} > ?".format(accuracy)
+            params.extend([exact_mass + tolerance, exact_mass - tolerance])
+
         self.cursor.execute("""SELECT DISTINCT 
                                                        C, 
                                                        H, 
@@ -252,53 +315,52 @@ class SubstructureDb:
                                                    FROM substructures 
                                                    WHERE heavy_atoms in ({})
                                                    AND exact_mass__{} {}
-                                                """.format(",".join(map(str, heavy_atoms)), accuracy, mass_statement))
+                                                """.format(",".join("?" * len(heavy_atoms)), accuracy, mass_statement),
+                            params)
 
         return self.cursor.fetchall()
 
     def paths(self, tree, cur=()):
-        if tree == {}:
-            yield cur
-        else:
-            for n, s in tree.items():
-                for path in self.paths(s, cur + (n,)):
-                    yield path
+        return _paths(tree, cur)
 
     def isomorphism_graphs(self, id_pkl):
-        with open(os.path.join(self.path_pkls, "{}.pkl".format(id_pkl)), 'rb') as pickle_file:
-            nGcomplete = pickle.load(pickle_file)
-        for p in self.paths(nGcomplete):
+        fn_pkl = os.path.join(self.path_pkls, "{}.pkl".format(id_pkl))
+        st = os.stat(fn_pkl)
+        for p in _load_isomorphism_graphs(fn_pkl, st.st_mtime_ns, st.st_size):
             yield p
 
     def k_configs(self):
         self.cursor.execute("""SELECT id_pkl, nodes_valences 
                                FROM subgraphs""")
-        records = self.cursor.fetchall()
-        configs = {}
-        for record in records:
-            configs[str(record[1])] = record[0]
-        return configs
+        return {str(record[1]): record[0] for record in self.cursor}
 
-    def select_sub_structures(self, l_atoms):
+    def select_sub_structures(self, l_atoms, sub_structures_cache=None):
 
-        subsets = []
-        for i in range(len(l_atoms)):
+        l_atoms = [tuple(atoms) for atoms in l_atoms]
 
-            self.cursor.execute("""SELECT DISTINCT lib 
+        # the same elemental compositions are requested for many combinations; when the caller passes a cache
+        # (elemental composition -> substructure libs), each composition is only queried and unpickled once
+        if sub_structures_cache is None:
+            sub_structures_cache = {}
+        missing = [atoms for atoms in OrderedDict.fromkeys(l_atoms) if atoms not in sub_structures_cache]
+        if missing:
+            self.cursor.execute("""SELECT DISTINCT C, H, N, O, P, S, lib 
                                    FROM substructures
-                                   WHERE C = {} 
-                                   AND H = {} 
-                                   AND N = {} 
-                                   AND O = {}
-                                   AND P = {}
-                                   AND S = {}
-                                """.format(l_atoms[i][0], l_atoms[i][1], l_atoms[i][2], l_atoms[i][3], l_atoms[i][4],
-                                           l_atoms[i][5]))
-            records = self.cursor.fetchall()
-            if len(records) == 0:
+                                   WHERE (C, H, N, O, P, S) IN (VALUES {})
+                                """.format(",".join(["(?,?,?,?,?,?)"] * len(missing))),
+                                [a for atoms in missing for a in atoms])
+            records = {}
+            for record in self.cursor:
+                records.setdefault(record[:6], []).append(record[6])
+
+            for atoms in missing:
+                sub_structures_cache[atoms] = [_loads_lib(lib) for lib in records.get(atoms, [])]
+
+        subsets = []
+        for atoms in l_atoms:
+            if len(sub_structures_cache[atoms]) == 0:
                 return []
-            ss = [pickle.loads(record[0]) for record in records]
-            subsets.append(ss)
+            subsets.append(sub_structures_cache[atoms])
 
         return subsets
 
@@ -356,6 +418,7 @@ class SubstructureDb:
         self.cursor.execute("""DROP INDEX IF EXISTS heavy_atoms__Valence__mass__0_001__idx""")
         self.cursor.execute("""DROP INDEX IF EXISTS heavy_atoms__Valence__mass__0_0001__idx""")
         self.cursor.execute("""DROP INDEX IF EXISTS atoms__Valence__idx""")
+        self.cursor.execute("""DROP INDEX IF EXISTS hmdbid_substructures__smiles__idx""")
 
         self.cursor.execute("""CREATE INDEX heavy_atoms__Valence__mass__1__idx 
                                ON substructures (heavy_atoms, valence, valence_atoms, exact_mass__1);""")
@@ -369,62 +432,53 @@ class SubstructureDb:
                                ON substructures (heavy_atoms, valence, valence_atoms, exact_mass__0_0001);""")
         self.cursor.execute("""CREATE INDEX atoms__Valence__idx 
                                ON substructures (C, H, N, O, P, S, valence, valence_atoms);""")
+        self.cursor.execute("""CREATE INDEX hmdbid_substructures__smiles__idx 
+                               ON hmdbid_substructures (smiles_rdkit_kek, hmdbid);""")
+
+        # approximate statistics are enough for the planner and keep ANALYZE cheap on large databases
+        # (ignored by SQLite versions older than 3.32)
+        self.cursor.execute("""PRAGMA analysis_limit=1000""")
+        self.cursor.execute("""ANALYZE""")
 
     def close(self):
         self.conn.close()
 
 
 def get_substructure(mol, idxs_edges_subgraph, debug=False):
-    atom_idxs_subgraph = []
+    atom_idxs_subgraph = set()
     for bIdx in idxs_edges_subgraph:
         b = mol.GetBondWithIdx(bIdx)
-        a1 = b.GetBeginAtomIdx()
-        a2 = b.GetEndAtomIdx()
+        atom_idxs_subgraph.add(b.GetBeginAtomIdx())
+        atom_idxs_subgraph.add(b.GetEndAtomIdx())
 
-        if a1 not in atom_idxs_subgraph:
-            atom_idxs_subgraph.append(a1)
-        if a2 not in atom_idxs_subgraph:
-            atom_idxs_subgraph.append(a2)
-
-    atoms_to_dummy = []
+    atoms_to_dummy = set()
     for idx in atom_idxs_subgraph:
         for atom in mol.GetAtomWithIdx(idx).GetNeighbors():
             if atom.GetIdx() not in atom_idxs_subgraph:
-                atoms_to_dummy.append(atom.GetIdx())
+                atoms_to_dummy.add(atom.GetIdx())
 
-    mol_edit = Chem.EditableMol(mol)
     degree_atoms = {}
 
     # Returns the type of the bond as a double (i.e. 1.0 for SINGLE, 1.5 for AROMATIC, 2.0 for DOUBLE)
 
+    # replace neighbouring atoms with dummies and remove all other atoms in a single pass (high to low index)
+    mol_edit = Chem.RWMol(mol)
     for atom in reversed(mol.GetAtoms()):
-
         if atom.GetIdx() in atoms_to_dummy:
             mol_edit.ReplaceAtom(atom.GetIdx(), Chem.Atom("*"))
-
-    mol = mol_edit.GetMol()
-    mol_edit = Chem.EditableMol(mol)
-
-    for atom in reversed(mol.GetAtoms()):
-        if atom.GetIdx() not in atom_idxs_subgraph and atom.GetSymbol() != "*":
+        elif atom.GetIdx() not in atom_idxs_subgraph and atom.GetSymbol() != "*":
             mol_edit.RemoveAtom(atom.GetIdx())
 
     mol_out = mol_edit.GetMol()
 
-    dummies = [atom.GetIdx() for atom in mol_out.GetAtoms() if atom.GetSymbol() == "*"]
-
-    for atom in mol_out.GetAtoms():
-
-        if atom.GetIdx() in dummies:
+    dummies = [atom.GetIdx() for atom in mol_out.GetAtoms() if atom.GetAtomicNum() == 0]
 
-            for atom_n in atom.GetNeighbors():
-
-                if atom_n.GetSymbol() == "*":
-                    continue  # do not count dummies for valence calculations
-                elif atom_n.GetIdx() not in degree_atoms:
-                    degree_atoms[atom_n.GetIdx()] = 1
-                else:
-                    degree_atoms[atom_n.GetIdx()] += 1
+    # walk the neighbours of the dummies only (low to high index, keeps the order of degree_atoms)
+    for idx in dummies:
+        for atom_n in mol_out.GetAtomWithIdx(idx).GetNeighbors():
+            if atom_n.GetAtomicNum() == 0:
+                continue  # do not count dummies for valence calculations
+            degree_atoms[atom_n.GetIdx()] = degree_atoms.get(atom_n.GetIdx(), 0) + 1
 
     bond_types = {}
 
@@ -432,20 +486,16 @@ def get_substructure(mol, idxs_edges_subgraph, debug=False):
         if debug:
             print(b.GetBondTypeAsDouble())
             print(b.GetBondType())
-            print(b.GetBeginAtomIdx(), b.GetEndAtomIdx(), mol_out.GetAtomWithIdx(b.GetBeginAtomIdx()).GetSymbol(),
-                  mol_out.GetAtomWithIdx(b.GetEndAtomIdx()).GetSymbol())
+            print(b.GetBeginAtomIdx(), b.GetEndAtomIdx(), b.GetBeginAtom().GetSymbol(), b.GetEndAtom().GetSymbol())
 
-        if mol_out.GetAtomWithIdx(b.GetBeginAtomIdx()).GetSymbol() == "*":
-            if b.GetEndAtomIdx() not in bond_types:
-                bond_types[b.GetEndAtomIdx()] = [b.GetBondTypeAsDouble()]
-            else:
-                bond_types[b.GetEndAtomIdx()].append(b.GetBondTypeAsDouble())
+        if b.GetBeginAtom().GetAtomicNum() == 0:
+            idx = b.GetEndAtomIdx()
+        elif b.GetEndAtom().GetAtomicNum() == 0:
+            idx = b.GetBeginAtomIdx()
+        else:
+            continue
 
-        elif mol_out.GetAtomWithIdx(b.GetEndAtomIdx()).GetSymbol() == "*":
-            if b.GetBeginAtomIdx() not in bond_types:
-                bond_types[b.GetBeginAtomIdx()] = [b.GetBondTypeAsDouble()]
-            else:
-                bond_types[b.GetBeginAtomIdx()].append(b.GetBondTypeAsDouble())
+        bond_types.setdefault(idx, []).append(b.GetBondTypeAsDouble())
 
     try:
         Chem.rdmolops.Kekulize(mol_out)
@@ -461,26 +511,48 @@ def get_substructure(mol, idxs_edges_subgraph, debug=False):
             "dummies": dummies}
 
 
-def get_elements(mol, elements=None):
-    if not elements:
-        elements = {"C": 0, "H": 0, "N": 0, "O": 0, "P": 0, "S": 0, "*": 0}
-    mol = Chem.AddHs(mol)
-    for atom in mol.GetAtoms():
-        elements[atom.GetSymbol()] += 1
-    return elements
+_ELEMENT_ATOMIC_NUMS = OrderedDict([("C", 6), ("H", 1), ("N", 7), ("O", 8), ("P", 15), ("S", 16), ("*", 0)])
+
 
+def _exact_mass_table(exact_mass_elements):
+    # element masses indexed by atomic number; dummy atoms (0) and unlisted elements weigh nothing
+    masses = [0.0] * 119
+    for symbol, mass in exact_mass_elements.items():
+        if symbol != "*":
+            masses[Chem.GetPeriodicTable().GetAtomicNumber(symbol)] = mass
+    return masses
 
-def calculate_exact_mass(mol, exact_mass_elements=None):
+
+_EXACT_MASSES = _exact_mass_table({"C": 12.0, "H": 1.007825, "N": 14.003074, "O": 15.994915, "P": 30.973763,
+                                   "S": 31.972072})
+
+
+def atom_profile(mol, exact_mass_elements=None):
+    # elemental composition and exact mass in a single pass over the heavy atoms (no Chem.AddHs)
     if not exact_mass_elements:
-        exact_mass_elements = {"C": 12.0, "H": 1.007825, "N": 14.003074, "O": 15.994915, "P": 30.973763, "S": 31.972072,
-                               "*": -1.007825}
+        masses = _EXACT_MASSES
+    else:
+        masses = _exact_mass_table(exact_mass_elements)
+    counts = [0] * 119
     exact_mass = 0.0
-    mol = Chem.AddHs(mol)
+    num_hs = 0
+    mol.UpdatePropertyCache(strict=False)
     for atom in mol.GetAtoms():
-        atomSymbol = atom.GetSymbol()
-        if atomSymbol != "*":
-            exact_mass += exact_mass_elements[atomSymbol]
-    return exact_mass
+        atomic_num = atom.GetAtomicNum()
+        counts[atomic_num] += 1
+        if atomic_num:
+            exact_mass += masses[atomic_num]
+            num_hs += atom.GetTotalNumHs()
+    counts[1] += num_hs
+    elements = {symbol: counts[atomic_num] for symbol, atomic_num in _ELEMENT_ATOMIC_NUMS.items()}
+    # add hydrogens one at a time, in the same order as Chem.AddHs, to keep the rounded masses unchanged
+    mass_h = masses[1]
+    for i in range(num_hs):
+        exact_mass += mass_h
+    return elements, exact_mass
+
+
+_ALLOWED_ATOMIC_NUMS = frozenset([1, 6, 7, 8, 15, 16])  # H, C, N, O, P, S
 
 
 def filter_records(records, db_type="hmdb"):
@@ -501,25 +573,23 @@ def _filter_hmdb_records(records):
             if mol.GetNumHeavyAtoms() < 4:
                 continue
 
-            atom_check = [True for atom in mol.GetAtoms() if atom.GetSymbol() not in ["C", "H", "N", "O", "P", "S"]]
-            if len(atom_check) > 0:
+            # charged species are rejected on the atoms, before the SMILES is generated
+            if any(atom.GetAtomicNum() not in _ALLOWED_ATOMIC_NUMS or atom.GetFormalCharge() != 0
+                   for atom in mol.GetAtoms()):
+                # print record['HMDB_ID'], record['smiles'], "+/-"
                 continue
 
-            smiles = Chem.rdmolfiles.MolToSmiles(mol, kekuleSmiles=True)
+            # kekuleSmiles=True kekulizes a copy of the mol, so both SMILES strings are identical
             Chem.rdmolops.Kekulize(mol)
             smiles_rdkit_kek = Chem.rdmolfiles.MolToSmiles(mol, kekuleSmiles=True)
-
-            if "+" in smiles_rdkit_kek or "-" in smiles_rdkit_kek or "+" in smiles or "-" in smiles:
-                # print record['HMDB_ID'], record['smiles'], "+/-"
-                continue
+            smiles = smiles_rdkit_kek
 
             # try:
             #     print("%s\t%s" % (record['accession'], record['monisotopic_molecular_weight']))
             # except KeyError:
             #     print(record['accession'])
 
-            els = get_elements(mol)
-            exact_mass = calculate_exact_mass(mol)
+            els, exact_mass = atom_profile(mol)
 
             record_dict = {'HMDB_ID': record['accession'],
                            'formula': record["chemical_formula"],
@@ -544,16 +614,10 @@ def get_substructure_bond_idx(prb_mol, ref_mol):
     else:
         return None
 
-    bond_idx = ()
-    for atom in ref_mol.GetAtoms():
-        if atom.GetIdx() in atom_idx:
-            for bond in atom.GetBonds():
-                # GetBondBetweenAtoms()
-                if bond.GetBeginAtomIdx() in atom_idx and bond.GetEndAtomIdx() in atom_idx:
-                    if bond.GetIdx() not in bond_idx:
-                        bond_idx = (*bond_idx, bond.GetIdx())
-
-    return bond_idx
+    # bonds induced by the matched atoms, in a single walk over the bonds
+    atom_idx = set(atom_idx)
+    return tuple(bond.GetIdx() for bond in ref_mol.GetBonds()
+                 if bond.GetBeginAtomIdx() in atom_idx and bond.GetEndAtomIdx() in atom_idx)
 
 
 def subset_sgs_sizes(sgs, n_min, n_max):
@@ -572,6 +636,9 @@ def subset_sgs_sizes(sgs, n_min, n_max):
     return sgs_new
 
 
+_DUMMY_PATT = Chem.MolFromSmarts('[#0]')  # attachment points left by RECAP/BRICS
+
+
 def get_sgs(record_dict, n_min, n_max, method="exhaustive"):
     if method == "exhaustive":
         return Chem.rdmolops.FindAllSubgraphsOfLengthMToN(record_dict["mol"], n_min, n_max)
@@ -580,33 +647,42 @@ def get_sgs(record_dict, n_min, n_max, method="exhaustive"):
         hierarchy = Recap.RecapDecompose(record_dict["mol"])
         sgs = []
         for substructure in hierarchy.GetAllChildren().values():
-            substructure = Chem.DeleteSubstructs(substructure.mol, Chem.MolFromSmarts('[#0]'))
+            substructure = Chem.DeleteSubstructs(substructure.mol, _DUMMY_PATT)
+            # a match induces at least the bonds of the fragment; skip fragments that are too large
+            if substructure.GetNumBonds() > n_max:
+                continue
             edge_idxs = get_substructure_bond_idx(substructure, record_dict["mol"])
-            if edge_idxs is not None:
+            if edge_idxs is not None and n_min <= len(edge_idxs) <= n_max:
                 sgs.append(edge_idxs)
-        return subset_sgs_sizes([sgs], n_min, n_max)
+        return [sgs] if sgs else []
 
     elif method == "BRICS":
         substructures = BRICS.BRICSDecompose(record_dict["mol"])
         sgs = []
         for substructure in substructures:
-            substructure = Chem.DeleteSubstructs(Chem.MolFromSmiles(substructure), Chem.MolFromSmarts('[#0]'))
+            substructure = Chem.DeleteSubstructs(Chem.MolFromSmiles(substructure), _DUMMY_PATT)
+            # a match induces at least the bonds of the fragment; skip fragments that are too large
+            if substructure.GetNumBonds() > n_max:
+                continue
             edge_idxs = get_substructure_bond_idx(substructure, record_dict["mol"])
-            if edge_idxs is not None:
+            if edge_idxs is not None and n_min <= len(edge_idxs) <= n_max:
                 sgs.append(edge_idxs)
-        return subset_sgs_sizes([sgs], n_min, n_max)
-
+        return [sgs] if sgs else []
 
-def update_substructure_database(fn_hmdb, fn_db, n_min, n_max, records=None, method="exhaustive"):
-    conn = sqlite3.connect(fn_db)
-    cursor = conn.cursor()
 
-    if records is None:
-        records = parse_xml(fn_hmdb, reformat=False)
+def _begin_bulk_load(cursor):
+    # bulk load settings shared by the database builders; opens the transaction the rows are written in.
+    # the rollback journal is kept in memory (not persisted in the database file, unlike WAL)
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-262144")
+    cursor.execute("BEGIN")
 
-    for record_dict in filter_records(records):
 
-        cursor.execute("""INSERT OR IGNORE INTO compounds (
+def _insert_substructure_records(cursor, compounds, substructures, hmdbid_substructures):
+    # rows are plain tuples bound positionally, in the column order listed below
+    cursor.executemany("""INSERT OR IGNORE INTO compounds (
                               hmdbid, 
                               exact_mass, 
                               formula, 
@@ -614,14 +690,49 @@ def update_substructure_database(fn_hmdb, fn_db, n_min, n_max, records=None, met
                               smiles, 
                               smiles_rdkit, 
                               smiles_rdkit_kek)
-                          values (
-                              :HMDB_ID, 
-                              :exact_mass,
-                              :formula, 
-                              :C, :H, :N, :O, :P, :S, 
-                              :smiles, 
-                              :smiles_rdkit, 
-                              :smiles_rdkit_kek)""", record_dict)
+                          values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", compounds)
+
+    cursor.executemany("""INSERT OR IGNORE INTO substructures (
+                              smiles, 
+                              heavy_atoms, 
+                              length, 
+                              exact_mass__1, 
+                              exact_mass__0_1, 
+                              exact_mass__0_01, 
+                              exact_mass__0_001, 
+                              exact_mass__0_0001, 
+                              exact_mass, count, 
+                              C, 
+                              H, 
+                              N, 
+                              O, 
+                              P, 
+                              S, 
+                              valence, 
+                              valence_atoms, 
+                              atoms_available, 
+                              lib)
+                          values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", substructures)
+
+    cursor.executemany("""INSERT OR IGNORE INTO hmdbid_substructures (
+                              hmdbid, 
+                              smiles_rdkit_kek) 
+                          VALUES (?, ?)""", hmdbid_substructures)
+
+    del compounds[:], substructures[:], hmdbid_substructures[:]
+
+
+def _process_record(record, n_min, n_max, method):
+    # filter and fragment a single record; returns (compound_row, sub_rows, link_rows) or None
+    for record_dict in filter_records([record]):
+
+        compound = (record_dict["HMDB_ID"], record_dict["exact_mass"], record_dict["formula"],
+                    record_dict["C"], record_dict["H"], record_dict["N"],
+                    record_dict["O"], record_dict["P"], record_dict["S"],
+                    record_dict["smiles"], record_dict["smiles_rdkit"], record_dict["smiles_rdkit_kek"])
+
+        substructures, hmdbid_substructures = [], []
+        seen_sub = set()
 
         # Returns a tuple of 2-tuples with bond IDs
 
@@ -631,213 +742,288 @@ def update_substructure_database(fn_hmdb, fn_db, n_min, n_max, records=None, met
                 if lib is None:
                     continue
 
-                smiles_rdkit_kek = Chem.rdmolfiles.MolToSmiles(lib["mol"], kekuleSmiles=True)
-
-                exact_mass = calculate_exact_mass(lib["mol"])
-                els = get_elements(lib["mol"])
-
-                pkl_lib = pickle.dumps(lib)
-                sub_smi_dict = {'smiles': smiles_rdkit_kek,
-                                'exact_mass': exact_mass,
-                                'count': 0,
-                                'length': sum([els[atom] for atom in els if atom != "*"]),
-                                "valence": lib["valence"],
-                                "valence_atoms": str(lib["degree_atoms"]),
-                                "atoms_available": lib["atoms_available"],
-                                "lib": pkl_lib}
-
-                sub_smi_dict["exact_mass__1"] = round(sub_smi_dict["exact_mass"], 0)
-                sub_smi_dict["exact_mass__0_1"] = round(sub_smi_dict["exact_mass"], 1)
-                sub_smi_dict["exact_mass__0_01"] = round(sub_smi_dict["exact_mass"], 2)
-                sub_smi_dict["exact_mass__0_001"] = round(sub_smi_dict["exact_mass"], 3)
-                sub_smi_dict["exact_mass__0_0001"] = round(sub_smi_dict["exact_mass"], 4)
-
-                sub_smi_dict.update(els)
-                sub_smi_dict["heavy_atoms"] = sum([els[atom] for atom in els if atom != "H" and atom != "*"])
-
-                cursor.execute("""INSERT OR IGNORE INTO substructures (
-                                      smiles, 
-                                      heavy_atoms, 
-                                      length, 
-                                      exact_mass__1, 
-                                      exact_mass__0_1, 
-                                      exact_mass__0_01, 
-                                      exact_mass__0_001, 
-                                      exact_mass__0_0001, 
-                                      exact_mass, count, 
-                                      C, 
-                                      H, 
-                                      N, 
-                                      O, 
-                                      P, 
-                                      S, 
-                                      valence, 
-                                      valence_atoms, 
-                                      atoms_available, 
-                                      lib)
-                                  values (
-                                      :smiles,
-                                      :heavy_atoms,
-                                      :length,
-                                      :exact_mass__1,
-                                      :exact_mass__0_1,
-                                      :exact_mass__0_01,
-                                      :exact_mass__0_001,
-                                      :exact_mass__0_0001,
-                                      :exact_mass,
-                                      :count,
-                                      :C,
-                                      :H,
-                                      :N,
-                                      :O,
-                                      :P,
-                                      :S,
-                                      :valence,
-                                      :valence_atoms,
-                                      :atoms_available,:lib)
-                               """, sub_smi_dict)
-
-                cursor.execute("""INSERT OR IGNORE INTO hmdbid_substructures (
-                                      hmdbid, 
-                                      smiles_rdkit_kek) 
-                                  VALUES ("%s", "%s")
-                               """ % (record_dict['HMDB_ID'], smiles_rdkit_kek))
-    conn.commit()
-    conn.close()
+                smiles_rdkit_kek = lib["smiles"]  # kekulized SMILES, generated once in get_substructure
 
+                # a substructure (and its link) is only profiled and pickled once per record
+                if smiles_rdkit_kek in seen_sub:
+                    continue
+                seen_sub.add(smiles_rdkit_kek)
 
-def create_isomorphism_database(db_out, pkls_out, boxes, sizes, path_geng=None, path_RI=None):
-    conn = sqlite3.connect(db_out)
+                els, exact_mass = atom_profile(lib["mol"])
+                heavy_atoms = els["C"] + els["N"] + els["O"] + els["P"] + els["S"]
+
+                substructures.append((smiles_rdkit_kek,
+                                      heavy_atoms,
+                                      heavy_atoms + els["H"],  # length
+                                      round(exact_mass, 0),
+                                      round(exact_mass, 1),
+                                      round(exact_mass, 2),
+                                      round(exact_mass, 3),
+                                      round(exact_mass, 4),
+                                      exact_mass,
+                                      0,  # count
+                                      els["C"], els["H"], els["N"], els["O"], els["P"], els["S"],
+                                      lib["valence"],
+                                      repr(sorted(lib["degree_atoms"].items())),  # valence_atoms, in atom order
+                                      lib["atoms_available"],
+                                      _dumps_lib(lib)))
+                hmdbid_substructures.append((record_dict['HMDB_ID'], smiles_rdkit_kek))
+
+        return compound, substructures, hmdbid_substructures
+
+    return None
+
+
+_RECORD_FIELDS = ("accession", "smiles", "chemical_formula")  # the fields read by _filter_hmdb_records
+
+
+def _record_fields(records):
+    # full HMDB records hold 100+ text fields; only send the ones that are used to the worker processes
+    for record in records:
+        yield {field: record[field] for field in _RECORD_FIELDS if field in record}
+
+
+def update_substructure_database(fn_hmdb, fn_db, n_min, n_max, records=None, method="exhaustive", batch_size=10000,
+                                 ncpus=1, chunksize=64):
+    conn = sqlite3.connect(fn_db)
     cursor = conn.cursor()
 
-    cursor.execute('''DROP TABLE IF EXISTS subgraphs''')
-    cursor.execute('''CREATE TABLE subgraphs (
-                          id_pkl INTEGER,
-                          n_graphs INTEGER,
-                          graph6 TEXT,
-                          k INTEGER,
-                          k_partite TEXT,
-                          k_valences TEXT,
-                          nodes_valences TEXT,
-                          n_nodes INTEGER,
-                          n_edges INTEGER,
-                          PRIMARY KEY (graph6, k_partite, nodes_valences)
-                   );''')
-    conn.commit()
+    # all rows are written in a single transaction
+    _begin_bulk_load(cursor)
 
-    id_pkl = 0
+    if records is None:
+        records = parse_xml(fn_hmdb)
 
-    for G, p in calculate_complete_multipartite_graphs(sizes, boxes):
+    process_record = functools.partial(_process_record, n_min=n_min, n_max=n_max, method=method)
 
-        print([path_geng, str(G.number_of_nodes()), "-d1", "-D2", "-q"])
-        proc = subprocess.Popen([path_geng, str(len(G.nodes)), "-d1", "-D2", "-q"], stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        geng_out, err = proc.communicate()
+    # records are fragmented by the worker processes; inserts stay on this (single writer) process.
+    # imap keeps the input order, so INSERT OR IGNORE keeps the same rows as a serial run.
+    if ncpus is None or ncpus > 1:
+        pool = multiprocessing.Pool(ncpus)
+        results = pool.imap(process_record, _record_fields(records), chunksize=chunksize)
+    else:
+        pool = None
+        results = map(process_record, records)
 
-        proc.stdout.close()
-        proc.stderr.close()
+    compounds, substructures, hmdbid_substructures = [], [], []
 
-        for i, line_geng in enumerate(geng_out.split()):
+    # substructures already stored (or queued) are not sent to INSERT OR IGNORE again
+    seen_sub = set(row[0] for row in cursor.execute("SELECT smiles FROM substructures"))
 
-            print(line_geng)
+    try:
+        for result in results:
+            if result is None:
+                continue
 
-            sG = nx.read_graph6(BytesIO(line_geng))
+            compounds.append(result[0])
+            for row in result[1]:
+                if row[0] not in seen_sub:
+                    seen_sub.add(row[0])
+                    substructures.append(row)
+            hmdbid_substructures.extend(result[2])
+
+            # most substructures are already stored or queued late in a run; count every buffered row
+            if len(substructures) + len(hmdbid_substructures) + len(compounds) >= batch_size:
+                _insert_substructure_records(cursor, compounds, substructures, hmdbid_substructures)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()  # do not wait for the remaining records to be fragmented
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    _insert_substructure_records(cursor, compounds, substructures, hmdbid_substructures)
+    conn.commit()
+    conn.close()
 
-            k_gfu = tempfile.NamedTemporaryFile(mode="w", delete=False)
-            k_gfu.write(graph_to_ri(G, "k_graph"))
-            k_gfu.seek(0)
 
-            s_gfu = tempfile.NamedTemporaryFile(mode="w", delete=False)
-            s_gfu.write(graph_to_ri(sG, "subgraph"))
-            s_gfu.seek(0)
+# RI input files are written to a RAM-backed tmpfs where available (None: the default temp directory)
+_SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
 
-            proc = subprocess.Popen([path_RI, "mono", "geu", k_gfu.name, s_gfu.name], stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            RI_out, err = proc.communicate()
 
-            k_gfu.close()
-            s_gfu.close()
+def _parse_map(line):
+    # RI mapping line, e.g. "{2:0, 0:2, 1:1}"
+    mapping = {}
+    for item in line.strip().strip("{}").split(","):
+        k, v = item.split(":", 1)
+        mapping[int(k)] = int(v)
+    return mapping
 
-            mappings = []
-            subgraphs = {}
 
-            for line in RI_out.decode("utf-8").splitlines():
-                if line[0] == "{":
-                    mappings.append(eval(line))
+def _match_subgraph(line_geng, p, fn_k_graph, path_RI):
+    # map a single geng graph onto the k-partite graph with RI; returns the graph and its edge sets per valence
+    sG = nx.read_graph6(BytesIO(line_geng))
+
+    # the temp file lives in shared memory (see _SCRATCH_DIR); it is removed whatever happens
+    s_gfu = tempfile.NamedTemporaryFile(mode="w", dir=_SCRATCH_DIR, delete=False)
+    try:
+        s_gfu.write(graph_to_ri(sG, "subgraph"))
+        s_gfu.close()
+
+        # stream the mappings from RI instead of reading its (potentially very large) output at once
+        proc = subprocess.Popen([path_RI, "mono", "geu", fn_k_graph, s_gfu.name], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1 << 20)
+
+        mappings = []
+        subgraphs = {}
+
+        try:
+            for line in proc.stdout:
+                if line.startswith("{"):
+                    mappings.append(_parse_map(line))
 
                 if len(mappings) == 20000:
                     gi = graph_info(p, sG, mappings, )
 
+                    # edge sets are deduplicated per valence configuration
                     for vn in gi[0]:
+                        subgraphs.setdefault(vn, {}).update(gi[0][vn])
+
+                    mappings = []
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+    finally:
+        s_gfu.close()
+        os.remove(s_gfu.name)
 
-                        if vn not in subgraphs:
-                            subgraphs[vn] = gi[0][vn]
-                            # print vn, result[0][vn], result[1][0], result[1][1], len(result[1][1])
-                        else:
+    if len(mappings) > 0:
+        gi = graph_info(p, sG, mappings, )
 
-                            before = len(subgraphs[vn])
-                            for es in gi[0][vn]:
-                                if es not in subgraphs[vn]:
-                                    subgraphs[vn].append(es)
-                                    # print vn, es, result[1][0], result[1][1], len(result[1][1])
-                            after = len(subgraphs[vn])
-                            print(before, after)
+        for vn in gi[0]:
+            subgraphs.setdefault(vn, {}).update(gi[0][vn])
 
-                    mappings = []
+    return sG, subgraphs
 
-            if len(mappings) > 0:
-                gi = graph_info(p, sG, mappings, )
-                # job = job_server.submit(graphInfo, (p, sG, mappings, ), (valences,), modules=(), globals=globals())
-                # jobs.append(job)
 
-                for vn in gi[0]:
+def create_isomorphism_database(db_out, pkls_out, boxes, sizes, path_geng=None, path_RI=None, ncpus=1,
+                                debug=False):
+    os.makedirs(pkls_out, exist_ok=True)
 
-                    if vn not in subgraphs:
-                        subgraphs[vn] = gi[0][vn]
-                        # print vn, result[0][vn], result[1][0], result[1][1], len(result[1][1])
-                    else:
+    conn = sqlite3.connect(db_out)
+    cursor = conn.cursor()
 
-                        before = len(subgraphs[vn])
-                        for es in gi[0][vn]:
-                            if es not in subgraphs[vn]:
-                                subgraphs[vn].append(es)
-                                # print vn, es, result[1][0], result[1][1], len(result[1][1])
-                        after = len(subgraphs[vn])
-                        print(before, after)
-
-            if len(subgraphs) > 0:
-
-                for vn in subgraphs:
-
-                    root = {}
-                    for fr in subgraphs[vn]:
-                        parent = root
-                        for e in fr:
-                            parent = parent.setdefault(e, {})
-
-                    vt = tuple([sum(v) for v in eval(vn)])
-                    print("INSERT:", i, line_geng.decode("utf-8"), len(subgraphs[vn]), len(p), str(p), vt, vn,
-                          sG.number_of_nodes(), sG.number_of_edges())
-
-                    id_pkl += 1
-                    cursor.execute('''INSERT INTO subgraphs (id_pkl, 
-                                      n_graphs, 
-                                      graph6,
-                                      k,
-                                      k_partite,
-                                      k_valences,
-                                      nodes_valences,
-                                      n_nodes, n_edges) 
-                                      values (?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-                        id_pkl,
-                        len(subgraphs[vn]),
-                        line_geng,
-                        len(p),
-                        str(p),
-                        str(vt),
-                        str(vn),
-                        sG.number_of_nodes(),
-                        sG.number_of_edges()))
-                    pickle.dump(root, open(os.path.join(pkls_out, "{}.pkl".format(id_pkl)), "wb"))
-            conn.commit()
+    cursor.execute('''DROP TABLE IF EXISTS subgraphs''')
+    cursor.execute('''CREATE TABLE subgraphs (
+                          id_pkl INTEGER,
+                          n_graphs INTEGER,
+                          graph6 TEXT,
+                          k INTEGER,
+                          k_partite TEXT,
+                          k_valences TEXT,
+                          nodes_valences TEXT,
+                          n_nodes INTEGER,
+                          n_edges INTEGER,
+                          PRIMARY KEY (graph6, k_partite, nodes_valences)
+                   );''')
+    conn.commit()
+
+    # all rows are written in a single transaction
+    _begin_bulk_load(cursor)
+
+    # the geng graphs are matched by worker processes; inserts and pickles stay on this process.
+    # imap keeps the geng order, so the id_pkl values are the same as for a serial run.
+    if ncpus is None or ncpus > 1:
+        pool = multiprocessing.Pool(ncpus)
+    else:
+        pool = None
+
+    id_pkl = 0
+
+    try:
+        for G, p in calculate_complete_multipartite_graphs(sizes, boxes):
+
+            if debug:
+                print([path_geng, str(G.number_of_nodes()), "-d1", "-D2", "-q"])
+            proc = subprocess.Popen([path_geng, str(len(G.nodes)), "-d1", "-D2", "-q"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            geng_out, err = proc.communicate()
+
+            proc.stdout.close()
+            proc.stderr.close()
+
+            # RI only reads the first graph of the query file, so the subgraphs cannot be matched in a single call;
+            # the k_graph (reference) file is the same for every subgraph and is written once; it lives in shared
+            # memory (see _SCRATCH_DIR) and is removed whatever happens
+            k_gfu = tempfile.NamedTemporaryFile(mode="w", dir=_SCRATCH_DIR, delete=False)
+            try:
+                k_gfu.write(graph_to_ri(G, "k_graph"))
+                k_gfu.close()
+
+                lines_geng = geng_out.split()
+                match_subgraph = functools.partial(_match_subgraph, p=p, fn_k_graph=k_gfu.name, path_RI=path_RI)
+                if pool is not None:
+                    results = pool.imap(match_subgraph, lines_geng)
+                else:
+                    results = map(match_subgraph, lines_geng)
+
+                for i, (line_geng, (sG, subgraphs)) in enumerate(zip(lines_geng, results)):
+
+                    if debug:
+                        print(line_geng)
+
+                    if len(subgraphs) > 0:
+
+                        rows = []
+                        for vn in subgraphs:
+
+                            # the edge sets are stored as a list rather than a trie, in the order the trie
+                            # (built from the edge sets in the order they were found) is walked by _paths
+                            trie = {}
+                            for edge_set in subgraphs[vn]:
+                                parent = trie
+                                for e in edge_set:
+                                    parent = parent.setdefault(e, {})
+                            edge_sets = list(_paths(trie))
+
+                            vt = tuple([sum(v) for v in ast.literal_eval(vn)])
+                            if debug:
+                                print("INSERT:", i, line_geng.decode("utf-8"), len(subgraphs[vn]), len(p), str(p), vt,
+                                      vn, sG.number_of_nodes(), sG.number_of_edges())
+
+                            id_pkl += 1
+                            rows.append((id_pkl,
+                                         len(subgraphs[vn]),
+                                         line_geng,
+                                         len(p),
+                                         str(p),
+                                         str(vt),
+                                         str(vn),
+                                         sG.number_of_nodes(),
+                                         sG.number_of_edges()))
+                            with open(os.path.join(pkls_out, "{}.pkl".format(id_pkl)), "wb") as pkl:
+                                pickle.dump(edge_sets, pkl, protocol=pickle.HIGHEST_PROTOCOL)
+
+                        cursor.executemany('''INSERT INTO subgraphs (id_pkl, 
+                                              n_graphs, 
+                                              graph6,
+                                              k,
+                                              k_partite,
+                                              k_valences,
+                                              nodes_valences,
+                                              n_nodes, n_edges) 
+                                              values (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            finally:
+                k_gfu.close()
+                os.remove(k_gfu.name)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()  # do not wait for (and spawn RI for) the remaining subgraphs
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    conn.commit()
     conn.close()
+
+    # the pickles have been rewritten in place
+    _load_isomorphism_graphs.cache_clear()
@@ -1,12 +1,13 @@
+import itertools
+import multiprocessing
 import os
 import subprocess
 import sys
 import tempfile
 
-sys.path.append(os.path.join("..", "metaboverse"))
-from databases import update_substructure_database, create_isomorphism_database
-from databases import SubstructureDb, ConnectivityDb
-from build_structures import standard_build
+from metaboverse.databases import parse_xml, update_substructure_database, create_isomorphism_database
+from metaboverse.databases import SubstructureDb, ConnectivityDb
+from metaboverse.build_structures import build
 
 
 def build_graph_isomorphism_database(sizes=[1, 2], boxes=3,
@@ -58,49 +59,77 @@ def build_substructure_database(records, path_input, path_db="../databases/subst
     db.create_compound_database()
     db.close()
 
-    for i, record in enumerate(records):
-        update_substructure_database(os.path.join(path_input, record + ".xml"), path_db, n_min, n_max, method=method)
+    # a single update (one connection and transaction) for all records
+    records_xml = itertools.chain.from_iterable(parse_xml(os.path.join(path_input, record + ".xml"))
+                                                for record in records)
+    update_substructure_database(None, path_db, n_min, n_max, records=records_xml, method=method)
 
     db = SubstructureDb(path_db, "", "")
     db.create_indexes()
     db.close()
 
 
+_db = None
+
+
+def _init_build_worker(path_db, path_pkls, path_db_k_graphs):
+    # one connection per worker process, reused for all of its records
+    global _db
+    _db = SubstructureDb(path_db, path_pkls, path_db_k_graphs)
+
+
+def _build_record(args):
+    record, fn_out, heavy_atoms, max_valence, accuracy = args
+    build(list(record[3:9]), record[1], _db, fn_out, heavy_atoms, max_valence, accuracy)
+    return record, fn_out
+
+
 def build_structures(accuracy=1, heavy_atoms=range(2, 9), max_valence=2,
                      path_db_k_graphs="../databases/k_graphs.sqlite",
                      path_pkls="../databases/pkls",
                      path_db="../databases/substructures.sqlite",
-                     path_out="results/"):
+                     path_out="results/", ncpus=None):
     db = SubstructureDb(path_db, path_pkls, path_db_k_graphs)
 
     # Select all HMDB compounds in database
     records = db.select_compounds()
-    for record in records:
-        print(record[0], str(record[11]))
-        print(record[3:9], record[1])
-        print("----------------------------------")
+    db.close()
+
+    # created once up front (and reused on reruns) rather than per compound
+    os.makedirs(os.path.join(path_out, "figures"), exist_ok=True)
+
+    # the compounds are built independently of each other; spread them over worker processes
+    jobs = [(record, os.path.join(path_out, "{}.smi".format(record[0])), heavy_atoms, max_valence, accuracy)
+            for record in records]
 
-        fn_out = os.path.join(path_out, "{}.smi".format(record[0]))
+    with multiprocessing.Pool(ncpus, initializer=_init_build_worker,
+                              initargs=(path_db, path_pkls, path_db_k_graphs)) as pool:
 
         # build & write structures
-        standard_build(list(record[3:9]), record[1], db, fn_out, heavy_atoms, max_valence, accuracy)
+        for record, fn_out in pool.imap_unordered(_build_record, jobs):
+            print(record[0], str(record[11]))
+            print(record[3:9], record[1])
+            print("----------------------------------")
 
-        # write figures to svg files
-        with open(fn_out) as smiles:
-            temp_fn = tempfile.NamedTemporaryFile(mode="w", delete=False)
-            for s in set(smiles.readlines()):
-                temp_fn.write(s)
+            # write figures to svg files
+            with open(fn_out) as smiles:
+                temp_fn = tempfile.NamedTemporaryFile(mode="w", delete=False)
+                # unique structures, in a single pass over the file
+                temp_fn.writelines(set(smiles))
 
-            subprocess.Popen(["obabel", "-ismi", os.path.join(path_out, temp_fn.name), "-osvg", "-O",
-                              os.path.join(path_out, "figures", "%s.svg" % (record[0]))],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                subprocess.Popen(["obabel", "-ismi", os.path.join(path_out, temp_fn.name), "-osvg", "-O",
+                                  os.path.join(path_out, "figures", "%s.svg" % (record[0]))],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-            temp_fn.seek(0)
-            temp_fn.close()
-    db.close()
+                temp_fn.seek(0)
+                temp_fn.close()
 
 
 if __name__ == "__main__":
+    # workers inherit the already imported RDKit/networkx modules instead of importing them again
+    if sys.platform.startswith("linux"):
+        multiprocessing.set_start_method("fork")
+
     build_graph_isomorphism_database()
     build_substructure_database(["HMDB0000001", "HMDB0000005", "HMDB0000008", "HMDB0000122"], "input")
     build_structures()
@@ -21,10 +21,13 @@
 
 
 import os
+import pickle
+import tempfile
 import unittest
 
 import numpy as np
 from metaboverse import *
+from metaboverse.databases import SubstructureDb, _load_isomorphism_graphs, parse_xml
 
 
 class DatabasesTestCase(unittest.TestCase):
@@ -32,6 +35,58 @@ class DatabasesTestCase(unittest.TestCase):
     def test_function(self):
         pass
 
+    def test_parse_xml_without_root_element(self):
+        with open(os.path.join(os.path.dirname(__file__), "..", "scripts", "input", "HMDB0000001.xml")) as inp:
+            xml_lines = inp.readlines()
+        self.assertTrue(xml_lines[0].startswith("<?xml"))
+        self.assertTrue(xml_lines[1].startswith("<hmdb"))
+        self.assertTrue(xml_lines[-1].startswith("</hmdb>"))
+
+        shapes = {"root": xml_lines,
+                  "root_no_declaration": xml_lines[1:],
+                  "no_root": [xml_lines[0]] + xml_lines[2:-1],
+                  "no_root_no_declaration": xml_lines[2:-1]}
+
+        with tempfile.TemporaryDirectory() as path_tmp:
+            records = {}
+            for shape, lines in shapes.items():
+                fn_xml = os.path.join(path_tmp, shape + ".xml")
+                with open(fn_xml, "w") as out:
+                    out.writelines(lines)
+                records[shape] = list(parse_xml(fn_xml))
+
+        for shape in shapes:
+            self.assertEqual(len(records[shape]), 1, shape)
+            self.assertEqual(records[shape], records["root"], shape)
+        self.assertEqual(records["root"][0]["accession"], "HMDB0000001")
+
+    def test_isomorphism_graphs_reloaded_after_rewrite(self):
+        with tempfile.TemporaryDirectory() as path_tmp:
+            path_pkls = os.path.join(path_tmp, "pkls")
+            os.makedirs(path_pkls)
+            fn_pkl = os.path.join(path_pkls, "1.pkl")
+            db = SubstructureDb(os.path.join(path_tmp, "substructures.sqlite"), path_pkls)
+
+            with open(fn_pkl, "wb") as pkl:
+                pickle.dump([((0, 1),), ((1, 0),)], pkl)
+            self.assertEqual(list(db.isomorphism_graphs(1)), [((0, 1),), ((1, 0),)])
+
+            # rewritten in place with a new timestamp
+            with open(fn_pkl, "wb") as pkl:
+                pickle.dump([((0, 2), (1, 3)), ((0, 2), (3, 1))], pkl)
+            os.utime(fn_pkl, ns=(os.stat(fn_pkl).st_atime_ns, os.stat(fn_pkl).st_mtime_ns + 10 ** 9))
+            self.assertEqual(list(db.isomorphism_graphs(1)), [((0, 2), (1, 3)), ((0, 2), (3, 1))])
+
+            # rewritten in place with the same size and timestamp; create_isomorphism_database clears the cache
+            st = os.stat(fn_pkl)
+            with open(fn_pkl, "wb") as pkl:
+                pickle.dump([((0, 3), (1, 2)), ((0, 3), (2, 1))], pkl)
+            os.utime(fn_pkl, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+            _load_isomorphism_graphs.cache_clear()
+            self.assertEqual(list(db.isomorphism_graphs(1)), [((0, 3), (1, 2)), ((0, 3), (2, 1))])
+            db.close()
+
 
 if __name__ == '__main__':
     unittest.main()